@@ -1,10 +1,17 @@
-import requests
-import json
+import httpx
+import diskcache
+import base64
+import orjson
 import argparse
 from datetime import datetime
+from itertools import groupby
 import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sqlite3
 import re
+from urllib.parse import urlparse, parse_qs
 from tqdm import tqdm
 
 parser = argparse.ArgumentParser(description='Tool for gathering and saving information from a Freshdesk instance.')
@@ -13,9 +20,10 @@ parser.add_argument('-d', '--domain', help='Specify the Freshdesk domain (ie <do
 parser.add_argument('-a', '--all', help='Specify if all tickets should be returned (potentially expensive)', required=False, action='store_true')
 parser.add_argument('-r', '--range', help='Specify a range of tickets to be retrieved', type=int, nargs=2)
 parser.add_argument('-l', '--limit', help='Rate limit threshold to pause script execution', type=int, default=1500)
-parser.add_argument('-p', '--pause', help='Pause duration in seconds when rate limit is close', type=int, default=300)  # 300 seconds = 5 minutes
+parser.add_argument('-p', '--pause', help='Pause duration in seconds when rate limited without a Retry-After header', type=int, default=300)  # 300 seconds = 5 minutes
 parser.add_argument('-s', '--delay', help='Delay in seconds between API requests', type=int, default=0)
 parser.add_argument('-u', '--updated_since', help='Fetch tickets updated since a specified date (format: YYYY-MM-DD)', type=str)
+parser.add_argument('-w', '--workers', help='Number of API requests to run concurrently', type=int, default=16)
 parser.add_argument('-D', '--debug', help='Enable debug messaging to the console output', required=False, action='store_true')
 parser.add_argument('-e', '--export', help='Select this mode for exporting the ticket data', required=False, action='store_true')
 
@@ -25,144 +33,335 @@ args = parser.parse_args()
 domain = args.domain
 api_key = args.key
 
-# Basic Authentication
-auth = (api_key, 'X')
+# Basic Authentication, encoded once and sent as a default header on every request
+auth_token = base64.b64encode(f'{api_key}:X'.encode()).decode()
 
-# Rate limit handling
-def check_rate_limit(rate_limit_remaining, rate_limit_total, pause_duration):
-    if int(rate_limit_remaining) <= args.limit:
-        tqdm.write("Approaching rate limit. Pausing execution...")
-        while True:
-            time.sleep(pause_duration)  # Pause for the specified duration
-
-            # Dummy request to check rate limit status
-            response = requests.get(f'https://{domain}.freshdesk.com/api/v2/tickets', auth=auth)
-            new_remaining = int(response.headers.get('X-Ratelimit-Remaining', 0))
-            new_total = int(response.headers.get('X-Ratelimit-Total', 1))
-
-            if new_remaining >= 0.9 * new_total:  # Check if the rate limit has reset to within 90% of the total
-                tqdm.write("Resuming execution...")
-                break
-            else:
-                tqdm.write(f"Waiting for rate limit to reset. Current remaining: {new_remaining}")
-
-# Function to fetch tickets
-def fetch_tickets(updated_since=None):
-    tickets = []
-    page = 1
-    max_pages = 300  # Freshdesk API limit
-    while page <= max_pages:
-        url = f'https://{domain}.freshdesk.com/api/v2/tickets?include=description&page={page}'
-        if updated_since:
-            url += f"&updated_since={updated_since}"
-        response = requests.get(url, auth=auth)
-        if response.status_code != 200:
-            tqdm.write(f"Stopping at page {page}. Response code: {response.status_code}, Message: {response.text}")
-            break
-
-        # Checking the rate limit headers
-        rate_limit_remaining = response.headers.get('X-Ratelimit-Remaining', '0')
-        rate_limit_total = response.headers.get('X-Ratelimit-Total', '1')
-
-        # Call the rate limit check function
-        check_rate_limit(rate_limit_remaining, rate_limit_total, args.pause)
-        # time.sleep(args.delay)
-
-        data = response.json()
-        if data:
-            tickets.extend(data)
-            page += 1
-        else:
-            break
+# Shared HTTP/2 client so requests from all worker threads are multiplexed over
+# pooled connections. httpx already asks for gzip (and br when brotli is installed).
+# Ticket pages, conversations and extra conversation pages are fetched by three pools of
+# --workers threads at the same time, so the pool is sized to keep a connection alive for each.
+pool_size = max(32, 3 * args.workers)
+transport = httpx.HTTPTransport(http2=True, retries=5,
+                                limits=httpx.Limits(max_keepalive_connections=pool_size, max_connections=2 * pool_size))
+client = httpx.Client(transport=transport, base_url=f'https://{domain}.freshdesk.com/api/v2', timeout=30.0,
+                      headers={'Authorization': f'Basic {auth_token}', 'Accept': 'application/json', 'User-Agent': 'freshdesk-scrape/1.0'})
 
-        page += 1
-    return tickets
+# On-disk cache of successful API responses, shared by all worker threads
+cache = diskcache.Cache('.fd_cache')
+cache_expiry = 86400  # 24 hours
 
-# Function to fetch conversations for a specific ticket
-def fetch_conversations(ticket_id):
-    conversations = []
+# Rate limit handling
+# Freshdesk rate limits are per minute, so the quota is treated as a token bucket
+# that refills evenly over the window. Requests from all worker threads wait
+# until the shared resume time before being sent.
+rate_limit_window = 60
+rate_limit_condition = threading.Condition()
+rate_limit_resume_at = 0.0
+
+def wait_for_rate_limit():
+    # Re-check after every wake-up, as another thread may have pushed the resume time back
+    with rate_limit_condition:
+        delay = rate_limit_resume_at - time.monotonic()
+        while delay > 0:
+            rate_limit_condition.wait(delay)
+            delay = rate_limit_resume_at - time.monotonic()
+
+def update_rate_limit(response):
+    global rate_limit_resume_at
+    if response.status_code == 429:
+        # Rate limited, Freshdesk tells us exactly how long to wait
+        pause = int(response.headers.get('Retry-After', args.pause))
+        tqdm.write(f"Rate limit reached. Pausing execution for {pause} seconds...")
+    else:
+        # Responses without rate-limit headers (e.g. a gateway error from a proxy) say nothing
+        # about the bucket, so they must not pause every worker thread
+        if 'X-Ratelimit-Remaining' not in response.headers or 'X-Ratelimit-Total' not in response.headers:
+            return
+        rate_limit_remaining = int(response.headers['X-Ratelimit-Remaining'])
+        rate_limit_total = int(response.headers['X-Ratelimit-Total'])
+        # Some requests cost more than one credit, so leave room for another one like this
+        request_cost = int(response.headers.get('X-Ratelimit-Used-Currentrequest', 1))
+        if rate_limit_remaining - request_cost > args.limit:
+            return
+        # Only wait as long as it takes for the bucket to refill above the threshold
+        refill_rate = rate_limit_total / rate_limit_window
+        pause = min((args.limit - rate_limit_remaining + request_cost) / refill_rate, rate_limit_window)
+        if args.debug: tqdm.write(f"Approaching rate limit. Pausing execution for {pause:.1f} seconds...")
+
+    with rate_limit_condition:
+        rate_limit_resume_at = max(rate_limit_resume_at, time.monotonic() + pause)
+
+def rate_limited_get(url, params=None, max_retries=5):
+    retries = 0
+    while True:
+        wait_for_rate_limit()
+        response = client.get(url, params=params)
+        update_rate_limit(response)
+        if response.status_code in (502, 503, 504) and retries < max_retries:
+            # Transient gateway errors, back off exponentially before retrying
+            time.sleep(0.5 * 2 ** retries)
+            retries += 1
+            continue
+        if response.status_code != 429:
+            return response
+
+# Largest page size Freshdesk allows on list endpoints
+per_page = 100
+
+# Shared by all conversation fetches for their remaining pages, so the number of requests
+# in flight stays bounded however many multi-page tickets are fetched at once
+page_executor = ThreadPoolExecutor(max_workers=args.workers)
+
+# Decode a JSON response body with orjson rather than the stdlib json module
+def parse_json(response):
+    return orjson.loads(response.content)
+
+# Function to fetch a single page from the API, returns None if the page could not be retrieved.
+# With raise_errors, a failed page raises httpx.HTTPStatusError instead.
+def fetch_page(url, page, raise_errors=False, **params):
+    response = rate_limited_get(url, params={**params, 'page': page})
+    if response.status_code != 200:
+        if raise_errors:
+            raise httpx.HTTPStatusError(f"Page {page} of {url} failed with response code {response.status_code}",
+                                        request=response.request, response=response)
+        tqdm.write(f"Stopping at page {page} of {url}. Response code: {response.status_code}, Message: {response.text}")
+        return None
+
+    if args.debug:
+        # One write per page rather than one per header
+        tqdm.write(f"Total Rate Limit: {response.headers.get('X-Ratelimit-Total')}, "
+                   f"Remaining Rate Limit: {response.headers.get('X-Ratelimit-Remaining')}, "
+                   f"Rate Limit Used in Current Request: {response.headers.get('X-Ratelimit-Used-Currentrequest')}")
+
+    time.sleep(args.delay)
+    return response
+
+# Page number of the rel="last" Link header, if Freshdesk sent one
+def last_page_number(response):
+    last_url = response.links.get('last', {}).get('url')
+    return int(parse_qs(urlparse(last_url).query)['page'][0]) if last_url else None
+
+# Function returning a page's body, whether Freshdesk reports a following page and the
+# last page number if known. A failed page raises, so a partial result is never mistaken
+# for a complete one. If cache_key is given, pages are cached on disk under (*cache_key, page).
+def fetch_page_content(url, page, cache_key=None, **params):
+    if cache_key:
+        cached = cache.get((*cache_key, page))
+        if cached is not None:
+            return cached
+    response = fetch_page(url, page, raise_errors=True, **params)
+    # Freshdesk only sends a rel="next" Link header when there are more pages
+    result = (response.content, 'next' in response.links, last_page_number(response))
+    if cache_key:
+        cache.set((*cache_key, page), result, expire=cache_expiry)
+    return result
+
+# Generator yielding every item of a paginated endpoint, stopping at the last page
+def paginate(url, cache_key=None, **params):
     page = 1
     while True:
-        url = f'https://{domain}.freshdesk.com/api/v2/tickets/{ticket_id}/conversations?page={page}'
-        response = requests.get(url, auth=auth)
-
-        # Existing rate limit header retrieval
-        rate_limit_remaining = response.headers.get('X-Ratelimit-Remaining', '0')
-        rate_limit_total = response.headers.get('X-Ratelimit-Total', '1')
-
-        # Call the rate limit check function
-        check_rate_limit(rate_limit_remaining, rate_limit_total, args.pause)
-
-        #rate_limit_total = response.headers.get('X-Ratelimit-Total')
-        #rate_limit_remaining = response.headers.get('X-Ratelimit-Remaining')
-        rate_limit_used_current = response.headers.get('X-Ratelimit-Used-Currentrequest')
+        content, has_next, last_page = fetch_page_content(url, page, cache_key, **params)
+        data = orjson.loads(content)
+        if not data:
+            return
+        yield from data
+        if not has_next:
+            return
+        page += 1
 
-        if args.debug:
-            tqdm.write(f"Total Rate Limit: {rate_limit_total}")
-            tqdm.write(f"Remaining Rate Limit: {rate_limit_remaining}")
-            tqdm.write(f"Rate Limit Used in Current Request: {rate_limit_used_current}")
+        # If Freshdesk tells us the last page, request all remaining pages at once
+        if last_page:
+            pages = range(page, last_page + 1)
+            for content, _, _ in page_executor.map(lambda p: fetch_page_content(url, p, cache_key, **params), pages):
+                data = orjson.loads(content)
+                if not data:
+                    return
+                yield from data
+            return
+
+# Generator yielding tickets page by page as they are retrieved
+def iter_tickets(updated_since=None):
+    url = '/tickets'
+    params = {'include': 'description', 'per_page': per_page}
+    if updated_since:
+        params['updated_since'] = updated_since
+    max_pages = 300  # Freshdesk API limit, i.e. up to 300 * per_page tickets
+    batch_size = 8  # Pages requested at once while the last page is unknown
+
+    response = fetch_page(url, 1, **params)
+    data = parse_json(response) if response is not None else None
+    if not data:
+        return
+    yield from data
+    if args.debug: tqdm.write(f"Response Content-Encoding: {response.headers.get('Content-Encoding')}")
+    if 'next' not in response.links:
+        return
+
+    # If Freshdesk tells us the last page, request all remaining pages at once.
+    # Otherwise request them in batches and stop at the first page without a next link.
+    last_page = last_page_number(response)
+    if last_page:
+        last_page = min(last_page, max_pages)
+        batch_size = max(last_page - 1, 1)
+    else:
+        last_page = max_pages
+
+    page = 2
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        while page <= last_page:
+            pages = range(page, min(page + batch_size, last_page + 1))
+            for response in executor.map(lambda p: fetch_page(url, p, **params), pages):
+                data = parse_json(response) if response is not None else None
+                if not data:
+                    return
+                yield from data
+                if 'next' not in response.links:
+                    return
+            page += batch_size
 
-        time.sleep(args.delay)
+# Function to fetch tickets
+def fetch_tickets(updated_since=None):
+    return list(iter_tickets(updated_since))
 
-        data = response.json()
-        if data:
-            conversations.extend(data)
-            page += 1
-        else:
-            break
-    return conversations
+# Function to fetch conversations for a specific ticket
+# Pages are cached against the ticket's updated_at, so only changed tickets go back to the API
+def fetch_conversations(ticket_id, updated_at=None):
+    cache_key = ('conversation_pages', ticket_id, updated_at) if updated_at else None
+    return list(paginate(f'/tickets/{ticket_id}/conversations', cache_key, per_page=per_page))
 
 
 def fetch_ticket_range(int1, int2, all_tickets):
     ticket_range_data = []
     if int1 <= int2:
-        # Filter tickets that fall within the specified range
-        valid_ticket_ids = [ticket['id'] for ticket in all_tickets if int1 <= ticket['id'] <= int2]
-
-        for ticket_id in valid_ticket_ids:
-            try:
-                conversations = fetch_conversations(ticket_id)
-                ticket_range_data.append({
-                    'ticket_id': ticket_id,
-                    'conversations': conversations
-                })
-            except requests.exceptions.RequestException as e:
-                tqdm.write(f"Error fetching data for ticket ID {ticket_id}: {e}")
+        # Filter tickets that fall within the specified range, walking whichever
+        # of the range and the ticket list is smaller
+        if int2 - int1 < len(all_tickets):
+            tickets_by_id = {ticket['id']: ticket for ticket in all_tickets}
+            valid_tickets = [tickets_by_id[ticket_id] for ticket_id in range(int1, int2 + 1) if ticket_id in tickets_by_id]
+        else:
+            valid_tickets = [ticket for ticket in all_tickets if int1 <= ticket['id'] <= int2]
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(fetch_conversations, ticket['id'], ticket['updated_at']): ticket['id'] for ticket in valid_tickets}
+            for future in as_completed(futures):
+                ticket_id = futures[future]
+                try:
+                    conversations = future.result()
+                    ticket_range_data.append({
+                        'ticket_id': ticket_id,
+                        'conversations': conversations
+                    })
+                except httpx.HTTPError as e:
+                    tqdm.write(f"Error fetching data for ticket ID {ticket_id}: {e}")
     else:
         tqdm.write("Invalid range: int1 should be less than or equal to int2")
     return ticket_range_data
 
 
-def store_ticket(ticket, cursor):
-    # Check if the ticket is already in the database
-    cursor.execute('SELECT * FROM tickets WHERE id = ?', (ticket['id'],))
-    if cursor.fetchone() is None:
-        # Ticket not in database, insert it
-        cursor.execute('INSERT INTO tickets (id, created_at, updated_at, subject, description, severity, region, other_ticket_info) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                       (ticket['id'], ticket['created_at'], ticket['updated_at'], ticket['subject'], strip_email_headers(ticket['description_text']), ticket['custom_fields']['severity'], ticket['custom_fields']['cf_ticket_region'], json.dumps(ticket)))
-        return True  # Indicates the ticket was stored
-    return False  # Indicates the ticket was already in the database
+# Rows are buffered and written in batches rather than one INSERT per row
+write_batch_size = 1000
+ticket_rows = []
+ticket_raw_rows = []
+conversation_rows = []
+
+# IDs already in the database, loaded once at startup so no per-row SELECT is needed.
+# Tickets map to their stored updated_at so changed tickets can be refreshed.
+known_tickets = {}
+known_conversation_ids = set()
+
+# SQL used for the batched inserts, kept identical so sqlite3 reuses its prepared statements
+insert_ticket_sql = 'INSERT OR REPLACE INTO tickets (id, created_at, updated_at, subject, description, severity, region) VALUES (?, ?, ?, ?, ?, ?, ?)'
+insert_ticket_raw_sql = 'INSERT OR REPLACE INTO ticket_raw (id, json) VALUES (?, ?)'
+insert_conversation_sql = 'INSERT OR IGNORE INTO conversations (ticket_id, conversation_id, created_at, persona, body) VALUES (?, ?, ?, ?, ?)'
+
+# Write the buffered rows in a single explicit transaction
+def flush_rows(cursor):
+    conn = cursor.connection
+    if not (ticket_rows or conversation_rows):
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(insert_ticket_sql, ticket_rows)
+        conn.executemany(insert_ticket_raw_sql, ticket_raw_rows)
+        conn.executemany(insert_conversation_sql, conversation_rows)
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    ticket_rows.clear()
+    ticket_raw_rows.clear()
+    conversation_rows.clear()
+
+def ticket_needs_update(ticket):
+    # Check if the ticket is already in the database and unchanged since it was stored
+    if known_tickets.get(ticket['id']) == ticket['updated_at']:
+        return False  # Indicates the ticket was already in the database and unchanged
+    known_tickets[ticket['id']] = ticket['updated_at']
+    return True  # Indicates the ticket is new or has been updated
+
+# The ticket row is buffered together with its conversations, so a committed batch never
+# holds a ticket whose conversations are missing. Otherwise a crash would leave the ticket
+# marked as up to date and its conversations would never be fetched.
+def store_ticket(ticket, conversations, cursor):
+    ticket_rows.append((ticket['id'], ticket['created_at'], ticket['updated_at'], ticket['subject'], strip_email_headers(ticket['description_text']), ticket['custom_fields']['severity'], ticket['custom_fields']['cf_ticket_region']))
+    # The full ticket JSON is kept out of the tickets table so its rows stay small
+    ticket_raw_rows.append((ticket['id'], sqlite3.Binary(orjson.dumps(ticket))))
+    store_conversations(ticket['id'], conversations, cursor)
 
 def store_conversation(ticket_id, conversation, cursor):
     # Check for existing conversation to avoid duplicates
-    cursor.execute('SELECT * FROM conversations WHERE conversation_id = ?', (conversation['id'],))
-    if cursor.fetchone() is None:
-        # Conversation not in database, insert it
-        isIncoming = conversation['incoming']
-        isPrivate = conversation['private']
-        persona = ''
-        if isIncoming and not isPrivate:
-            persona = 'Customer'
-        elif isIncoming and isPrivate:
-            persona = "Aqua Development Discussion"
-        elif not isIncoming and not isPrivate:
-            persona = 'Aqua Support Agent'
-        elif not isIncoming and isPrivate:
-            persona = 'Aqua Internal Discussion'
-        else: persona = 'Unknown User'
-        cursor.execute('INSERT INTO conversations (ticket_id, conversation_id, created_at, persona, body) VALUES (?, ?, ?, ?, ?)',
-                       (ticket_id, conversation['id'], conversation['created_at'], persona, conversation['body_text']))
+    if conversation['id'] in known_conversation_ids:
+        return
+    known_conversation_ids.add(conversation['id'])
+    isIncoming = conversation['incoming']
+    isPrivate = conversation['private']
+    persona = ''
+    if isIncoming and not isPrivate:
+        persona = 'Customer'
+    elif isIncoming and isPrivate:
+        persona = "Aqua Development Discussion"
+    elif not isIncoming and not isPrivate:
+        persona = 'Aqua Support Agent'
+    elif not isIncoming and isPrivate:
+        persona = 'Aqua Internal Discussion'
+    else: persona = 'Unknown User'
+    conversation_rows.append((ticket_id, conversation['id'], conversation['created_at'], persona, conversation['body_text']))
+
+# Batches are only flushed between tickets, never part way through one
+def store_conversations(ticket_id, conversations, cursor):
+    for conversation in conversations:
+        store_conversation(ticket_id, conversation, cursor)
+    if len(ticket_rows) >= write_batch_size or len(conversation_rows) >= write_batch_size:
+        flush_rows(cursor)
+
+# Runs the store functions put on the queue until it receives None, so that
+# SQLite is only ever written from this one thread. An exception stops the thread
+# and is appended to errors for the main thread to re-raise.
+def write_queued_rows(write_queue, errors):
+    try:
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            store_function, store_args = item
+            store_function(*store_args)
+    except BaseException as e:
+        errors.append(e)
 
+# Put an item on the write queue, failing instead of blocking forever if the writer has stopped
+def put_write(write_queue, writer, item):
+    while True:
+        try:
+            write_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            if not writer.is_alive():
+                raise RuntimeError("SQLite writer thread has stopped")
+
+
+# Regular expression to identify potential end of headers
+# This regex looks for two consecutive newline characters which often separate headers from the body
+end_of_headers_regex = re.compile(r"(?:\r?\n){2,}")
 
 def strip_email_headers(description):
     """
@@ -174,12 +373,16 @@ def strip_email_headers(description):
     Returns:
     str: The description with email headers removed.
     """
-    # Regular expression to identify potential end of headers
-    # This regex looks for two consecutive newline characters which often separate headers from the body
-    end_of_headers_regex = r"(\r?\n){2,}"
+    # Without carriage returns the end of the headers is simply the first blank line,
+    # which str.find locates without going through the regex engine
+    if '\r' not in description:
+        start_idx = description.find('\n\n')
+        if start_idx == -1:
+            return description
+        return description[start_idx + 2:].strip()
 
     # Find the end of the headers using regex
-    match = re.search(end_of_headers_regex, description)
+    match = end_of_headers_regex.search(description)
     
     if match:
         # Get the index where the body starts
@@ -189,15 +392,124 @@ def strip_email_headers(description):
         # If no pattern is found, return the original description
         return description
 
+# Fetch the conversations of any new or changed tickets, then store each ticket with its conversations
+def process_tickets(tickets, cursor):
+    global global_pbar
+    # Conversations are fetched by worker threads as soon as each new ticket arrives,
+    # overlapping with the rest of the ticket listing. All rows are handed to a single
+    # writer thread through a bounded queue, so disk writes overlap with network waits.
+    write_queue = queue.Queue(maxsize=64)
+    writer_errors = []
+    writer = threading.Thread(target=write_queued_rows, args=(write_queue, writer_errors))
+    writer.start()
+
+    def fetch_and_queue_ticket(ticket):
+        if not writer.is_alive():
+            return  # The writer failed, don't spend API calls on tickets that can't be stored
+        try:
+            conversations = fetch_conversations(ticket['id'], ticket['updated_at'])
+        except httpx.HTTPError as e:
+            # The ticket is left unstored, so the next run fetches it again
+            tqdm.write(f"Error fetching data for ticket ID {ticket['id']}: {e}")
+            return
+        put_write(write_queue, writer, (store_ticket, (ticket, conversations, cursor)))
+
+    # The progress bar exists from the start and grows as tickets are listed. Finished
+    # fetches are handed back through a queue so the bar is only touched from this thread.
+    global_pbar = tqdm(total=0, desc="Processing tickets", unit="ticket", mininterval=0.5)
+    completed = queue.SimpleQueue()
+
+    def finish(future):
+        future.result()
+        global_pbar.update()
+
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        submitted = 0
+        for ticket in tickets:
+            ticket_id = ticket['id']
+            if not writer.is_alive():
+                break  # The writer failed, its error is raised below
+
+            if ticket_needs_update(ticket):
+                if args.debug: tqdm.write(f"Fetching conversations for ticket ID {ticket_id}.")
+                executor.submit(fetch_and_queue_ticket, ticket).add_done_callback(completed.put)
+                submitted += 1
+                global_pbar.total = submitted
+                global_pbar.update(0)
+            else:
+                if args.debug: tqdm.write(f"Ticket ID {ticket_id} is already in the database and unchanged.")
+                # Don't attempt to store further conversations - assume they're already there
+
+            # Keep at most twice --workers tickets pending, so an error or Ctrl-C
+            # only has a little queued work to cancel
+            while not completed.empty() or submitted - global_pbar.n > 2 * args.workers:
+                finish(completed.get())
+
+        while writer.is_alive() and global_pbar.n < submitted:
+            finish(completed.get())
+    finally:
+        # Nothing is pending after a clean run, so this only cancels work after an error
+        executor.shutdown(wait=True, cancel_futures=True)
+        global_pbar.close()
+        if writer.is_alive():
+            try:
+                put_write(write_queue, writer, None)
+            except RuntimeError:
+                pass  # The writer stopped in the meantime, its error is raised below
+        writer.join()
+        if writer_errors:
+            raise writer_errors[0]
+        # The buffers only hold complete tickets, so they can be kept even after Ctrl-C
+        flush_rows(cursor)
+
+# Generator yielding one exported ticket at a time, so the whole database is never held in memory
+def export_tickets(conn):
+    # Querying the database for tickets and their conversations in a single pass
+    rows = conn.execute("""
+        SELECT t.id, t.created_at, t.updated_at, t.subject, t.description, t.severity, t.region,
+               c.conversation_id, c.created_at, c.persona, c.body
+        FROM tickets t LEFT JOIN conversations c
+            ON c.ticket_id = t.id
+            AND c.persona NOT IN ('Aqua Development Discussion', 'Aqua Internal Discussion')  -- Focus only on Support/Customer convos
+        ORDER BY t.id, c.created_at
+    """)
+    for ticket_id, ticket_group in groupby(rows, key=lambda row: row[0]):
+        # Organizing conversations
+        conversation_data = []
+        for _, created_at, updated_at, subject, description, severity, region, conversation_id, conversation_created_at, persona, body in ticket_group:
+            if conversation_id is None: continue  # Ticket has no exported conversations
+            conversation_data.append({
+                "conversation_id": conversation_id,
+                "created_at": conversation_created_at,
+                "persona": persona,
+                "body": body
+            })
+
+        # Organizing ticket data
+        yield {
+            "ticket_id": ticket_id,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "subject": subject,
+            "description": description,
+            "severity": severity,
+            "region": region,
+            "conversations": conversation_data
+        }
+
 # Main execution
-# all_conversations = []
 
 # Create a global tqdm instance for writing messages
 global_pbar = None
 
 # Establish a connection to the SQLite database
 database_file = 'tickets.db'
-conn = sqlite3.connect(database_file)
+# The connection is shared with the writer thread used by process_tickets. While that thread
+# runs, the main thread only reads from the API and never touches the connection.
+# Transactions are managed explicitly by flush_rows, so the connection runs in autocommit mode.
+conn = sqlite3.connect(database_file, isolation_level=None, cached_statements=256, check_same_thread=False)
+conn.executescript('PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-65536; PRAGMA wal_autocheckpoint=10000;')
 cursor = conn.cursor()
 
 # SQL to create 'tickets' table
@@ -209,8 +521,16 @@ CREATE TABLE IF NOT EXISTS tickets (
     subject TEXT,
     description TEXT,
     severity TEXT,
-    region TEXT,
-    other_ticket_info TEXT
+    region TEXT
+)
+'''
+
+# SQL to create 'ticket_raw' table holding the full ticket JSON returned by the API
+create_ticket_raw_table = '''
+CREATE TABLE IF NOT EXISTS ticket_raw (
+    id INTEGER PRIMARY KEY,
+    json BLOB,
+    FOREIGN KEY (id) REFERENCES tickets (id)
 )
 '''
 
@@ -229,104 +549,44 @@ CREATE TABLE IF NOT EXISTS conversations (
 
 # Execute the SQL commands to create the tables
 cursor.execute(create_tickets_table)
+cursor.execute(create_ticket_raw_table)
 cursor.execute(create_conversations_table)
+cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_conv ON conversations(conversation_id)')
+cursor.execute('CREATE INDEX IF NOT EXISTS ix_conv_ticket ON conversations(ticket_id, created_at)')
+
+known_tickets.update(cursor.execute('SELECT id, updated_at FROM tickets'))
+known_conversation_ids.update(row[0] for row in cursor.execute('SELECT conversation_id FROM conversations'))
 
 if args.updated_since:
     print(f"Fetching tickets updated since {args.updated_since}")
-    all_tickets = fetch_tickets(args.updated_since)
-    global_pbar = tqdm(all_tickets, desc="Processing tickets", unit="ticket")
-    for ticket in global_pbar:
-        ticket_id = ticket['id']
-
-        if store_ticket(ticket, cursor):
-            if args.debug: tqdm.write(f"Stored ticket ID {ticket_id} in the database.")
-        else:
-            if args.debug: tqdm.write(f"Ticket ID {ticket_id} is already in the database.")
-            continue # Don't attempt to store further conversations - assume they're already there
-
-        conversations = fetch_conversations(ticket_id)
-        for conversation in conversations:
-            store_conversation(ticket['id'], conversation, cursor)
-        # all_conversations.append({
-        #     'ticket_id': ticket_id,
-        #     'conversations': conversations
-        # })
+    process_tickets(iter_tickets(args.updated_since), cursor)
 elif args.all:
-    tickets = fetch_tickets()
-
-    global_pbar = tqdm(tickets, desc="Processing tickets", unit="ticket")
-    for ticket in global_pbar:
-        ticket_id = ticket['id']
-
-        if store_ticket(ticket, cursor):
-            if args.debug: tqdm.write(f"Stored ticket ID {ticket_id} in the database.")
-        else:
-            if args.debug: tqdm.write(f"Ticket ID {ticket_id} is already in the database.")
-            continue # Don't attempt to store further conversations - assume they're already there
-
-        conversations = fetch_conversations(ticket_id)
-        for conversation in conversations:
-            store_conversation(ticket['id'], conversation, cursor)
-        # all_conversations.append({
-        #     'ticket_id': ticket_id,
-        #     'conversations': conversations
-        # })
+    process_tickets(iter_tickets(), cursor)
 elif args.range:
     all_tickets = fetch_tickets()
     tqdm.write(f"Gathering ticket range: {args.range[0]} - {args.range[1]}" )
-    conversations = fetch_ticket_range(args.range[0], args.range[1], all_tickets)
-    for conversation in conversations:
-        store_conversation(conversation['ticket_id'], conversation, cursor)
-    # all_conversations = conversations
+    ticket_range_data = fetch_ticket_range(args.range[0], args.range[1], all_tickets)
+    for ticket_data in ticket_range_data:
+        store_conversations(ticket_data['ticket_id'], ticket_data['conversations'], cursor)
 elif args.export:
     tqdm.write("Exporting ticket data...")
 
-    # Querying the database for tickets and conversations
-    with sqlite3.connect(database_file) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM tickets")
-        tickets = cursor.fetchall()
-
-        # Preparing data structure for JSON export
-        tickets_data = []
-        for ticket in tickets:
-            ticket_id, created_at, updated_at, subject, description, severity, region, other_ticket_info = ticket
-            cursor.execute("SELECT * FROM conversations WHERE ticket_id = ? ORDER BY created_at", (ticket_id,))
-            conversations = cursor.fetchall()
-
-            # Organizing conversations
-            conversation_data = []
-            for conversation in conversations:
-                _, conversation_id, _, created_at, persona, body = conversation
-                if persona in ['Aqua Development Discussion','Aqua Internal Discussion']: continue  # Focus only on Support/Customer convos
-                conversation_data.append({
-                    "conversation_id": conversation_id,
-                    "created_at": created_at,
-                    "persona": persona,
-                    "body": body
-                })
-
-            # Organizing ticket data
-            tickets_data.append({
-                "ticket_id": ticket_id,
-                "created_at": created_at,
-                "updated_at": updated_at,
-                "subject": subject,
-                "description": description,
-                "severity": severity,
-                "region": region,
-                "conversations": conversation_data
-            })
-
-    # Writing data to JSON file
+    # Writing data to JSON file one ticket at a time
     export_filename = f"exported_tickets_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
-    with open(export_filename, 'w', encoding='utf-8') as file:
-        json.dump(tickets_data, file, ensure_ascii=False, indent=4)
+    with open(export_filename, 'wb') as file:
+        file.write(b'[')
+        for index, ticket_data in enumerate(export_tickets(conn)):
+            file.write(b',\n' if index else b'\n')
+            file.write(orjson.dumps(ticket_data, option=orjson.OPT_INDENT_2))
+        file.write(b'\n]\n')
 
     tqdm.write(f"Ticket data exported to {export_filename}")
 
-conn.commit()
+flush_rows(cursor)
 conn.close()
+page_executor.shutdown()
+client.close()
+cache.close()
 
 # current_time = datetime.now()
 # timestamp = current_time.strftime("%Y%m%d-%H%M%S")
@@ -1,28 +1,29 @@
-import json
+import mmap
+import orjson
 import argparse
+import os
+from multiprocessing import Pool
 import random
 import unicodedata
 import re
-from transformers import GPT2Tokenizer
+from transformers import GPT2TokenizerFast
+
+# Regex pattern for footer (adjust the pattern to match possible variations)
+footer_pattern = re.compile(r"Want to elevate your Aqua System Knowledge\?.*Aquademy", flags=re.DOTALL)
 
 def normalize_text(text):
     """
     Normalize the text by converting Unicode characters to their ASCII equivalents,
     removing newline characters, unnecessary whitespaces, and a specific footer.
     """
-    # Regex pattern for footer (adjust the pattern to match possible variations)
-    footer_pattern = r"Want to elevate your Aqua System Knowledge\?.*Aquademy"
-
     # Remove the footer using regex
-    text = re.sub(footer_pattern, '', text, flags=re.DOTALL)
+    text = footer_pattern.sub('', text)
 
-    # Normalize Unicode characters to ASCII
-    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    # Normalize Unicode characters to ASCII (pure ASCII text is already normalized)
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
 
-    # Replace newline characters with a space
-    text = text.replace('\n', ' ').replace('\r', ' ')
-
-    # Replace multiple spaces with a single space
+    # Collapse newlines and runs of whitespace into single spaces
     text = ' '.join(text.split())
 
     return text
@@ -52,49 +53,64 @@ def split_data(tickets, split_ratio=0.8):
     split_index = int(len(tickets) * split_ratio)
     return tickets[:split_index], tickets[split_index:]
 
-def tokenize_and_count(text, tokenizer):
+def format_tickets_to_jsonl(tickets):
+    """
+    Format the initial context and each conversation entry of every ticket into JSONL lines.
+    """
+    lines = []
+    for ticket in tickets:
+        lines.append(format_initial_context_to_jsonl(ticket['ticket_id'], ticket['subject'], ticket['description']))
+        for conversation in ticket['conversations']:
+            lines.append(format_conversation_entry_to_jsonl(ticket['ticket_id'], conversation))
+    return lines
+
+def format_tickets_to_jsonl_parallel(tickets, pool, processes):
+    """
+    Format tickets into JSONL lines across a pool of worker processes, preserving ticket order.
+    """
+    # Several chunks per process keep the workers evenly loaded
+    chunk_size = max(1, len(tickets) // (processes * 4))
+    chunks = [tickets[i:i + chunk_size] for i in range(0, len(tickets), chunk_size)]
+    return [line for lines in pool.map(format_tickets_to_jsonl, chunks) for line in lines]
+
+def tokenize_and_count(texts, tokenizer):
     """
-    Tokenize the text and return the count of tokens.
+    Tokenize the texts in a single batch with the Rust tokenizer and return the count of tokens for each.
     """
-    tokens = tokenizer.tokenize(text)
-    return len(tokens)
+    encodings = tokenizer.backend_tokenizer.encode_batch(texts, add_special_tokens=False)
+    return [len(encoding.ids) for encoding in encodings]
 
 def process_tickets(input_file, split_ratio=0.8):
     """
     Process a list of tickets from the input file, save the initial context and each conversation entry as separate JSONL lines, 
     and calculate token count statistics.
     """
-    tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+    tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
 
-    with open(input_file, 'r', encoding='utf-8') as file:
-        tickets = json.load(file)
+    # Parse the export straight from a memory map rather than reading it into a separate buffer first
+    with open(input_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            tickets = orjson.loads(view)
 
     training_tickets, validation_tickets = split_data(tickets, split_ratio)
-    training_token_counts = []
-    validation_token_counts = []
-
-    with open('training_data.jsonl', 'w', encoding='utf-8') as train_file, open('validation_data.jsonl', 'w', encoding='utf-8') as valid_file:
-        for ticket in training_tickets:
-            initial_context = format_initial_context_to_jsonl(ticket['ticket_id'], ticket['subject'], ticket['description'])
-            train_file.write(json.dumps({"text": initial_context}) + '\n')
-            token_count = tokenize_and_count(initial_context, tokenizer)
-            training_token_counts.append(token_count)
-            for conversation in ticket['conversations']:
-                jsonl_line = format_conversation_entry_to_jsonl(ticket['ticket_id'], conversation)
-                train_file.write(json.dumps({"text": jsonl_line}) + '\n')
-                token_count = tokenize_and_count(jsonl_line, tokenizer)
-                training_token_counts.append(token_count)
-
-        for ticket in validation_tickets:
-            initial_context = format_initial_context_to_jsonl(ticket['ticket_id'], ticket['subject'], ticket['description'])
-            valid_file.write(json.dumps({"text": initial_context}) + '\n')
-            token_count = tokenize_and_count(initial_context, tokenizer)
-            validation_token_counts.append(token_count)
-            for conversation in ticket['conversations']:
-                jsonl_line = format_conversation_entry_to_jsonl(ticket['ticket_id'], conversation)
-                valid_file.write(json.dumps({"text": jsonl_line}) + '\n')
-                token_count = tokenize_and_count(jsonl_line, tokenizer)
-                validation_token_counts.append(token_count)
+    # Text normalization is CPU-bound pure Python, so it is spread across all cores
+    processes = os.cpu_count() or 1
+    with Pool(processes) as pool:
+        training_lines = format_tickets_to_jsonl_parallel(training_tickets, pool, processes)
+        validation_lines = format_tickets_to_jsonl_parallel(validation_tickets, pool, processes)
+
+    with open('training_data.jsonl', 'wb', buffering=1 << 20) as train_file, open('validation_data.jsonl', 'wb', buffering=1 << 20) as valid_file:
+        for jsonl_line in training_lines:
+            train_file.write(orjson.dumps({"text": jsonl_line}))
+            train_file.write(b'\n')
+
+        for jsonl_line in validation_lines:
+            valid_file.write(orjson.dumps({"text": jsonl_line}))
+            valid_file.write(b'\n')
+
+    # Tokenize each set as one batch rather than line by line
+    training_token_counts = tokenize_and_count(training_lines, tokenizer)
+    validation_token_counts = tokenize_and_count(validation_lines, tokenizer)
 
     # Function to calculate and display statistics
     def display_stats(token_counts, dataset_name):